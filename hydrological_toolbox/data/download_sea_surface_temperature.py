@@ -1,21 +1,26 @@
 import logging
 import os
 import tempfile
-import urllib.request as request
 import warnings
-from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
-from typing import Union
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from netCDF4 import Dataset
-from scipy.spatial import KDTree
+import requests
+from netCDF4 import Dataset, date2num
+from scipy.spatial import cKDTree
 
 from ..data.util import DownloadProgressBar
 
 logger = logging.getLogger(__name__)
 
+# upper bound of simultaneous connections to the NOAA server, shared by all downloads in this process
+MAX_CONNECTIONS = 8
+_connection_slots = BoundedSemaphore(MAX_CONNECTIONS)
+
 
 class SeaSurfaceTempDownloader:
     """
@@ -28,49 +33,70 @@ class SeaSurfaceTempDownloader:
                  start_date: str,
                  end_date: str,
                  lat_col: str = 'LAT',
-                 lon_col: str = 'LON'):
+                 lon_col: str = 'LON',
+                 cache_dir: str = None):
         """
         Download the sea surface temperature (SST) data from NOAA.
         If the land coordinates are given, np.nan values will be returned in the dataframe
+
+        The yearly files are kept in cache_dir so that later calls do not download them again.
+        If not given, it falls back to the HYDRO_OISST_CACHE environment variable,
+        and then to ~/.cache/hydrological_toolkit/oisst
         """
-        self.sst_data_parent_dir = 'ftp://ftp.cdc.noaa.gov/Datasets/noaa.oisst.v2.highres/'
-        self.temp_dir = tempfile.mkdtemp()
+        self.sst_data_parent_dir = 'https://downloads.psl.noaa.gov/Datasets/noaa.oisst.v2.highres/'
+        if cache_dir is None:
+            cache_dir = os.environ.get('HYDRO_OISST_CACHE',
+                                       os.path.expanduser('~/.cache/hydrological_toolkit/oisst'))
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
 
         try:
             self.locations = locations[[lat_col, lon_col]]
         except KeyError:
             logger.critical(f'{lat_col} and {lon_col} are both needed')
             raise
+        self._locations_arr = np.ascontiguousarray(self.locations.to_numpy(), dtype=np.float64)
 
+        if pd.Timestamp(start_date) > pd.Timestamp(end_date):
+            raise ValueError(f'start_date {start_date} is later than end_date {end_date}')
         self.start_date = start_date
         self.end_date = end_date
 
+        # all the yearly files share the same 1/4 deg grid, so the indices only need to be computed once
+        self._grid_index_cache = None
+
     @classmethod
     def from_tuples(cls,
                     locations: Union[tuple, list],
                     start_date: str,
-                    end_date: str):
+                    end_date: str,
+                    cache_dir: str = None):
         """
         alternative constructor allows users to initialize the class from a list/tuple
         of coordinates.
         """
-
-        location_peek = locations[0]
-        if isinstance(location_peek, tuple) or isinstance(location_peek, list):
-            locations_df = pd.DataFrame(locations)
+        error_message = 'only two types of input are supported: 1. [10, 20] or [[10, 20], [30, 30]]'
+        try:
+            locations_arr = np.asarray(locations)
+        except (TypeError, ValueError):
+            raise TypeError(error_message)
+
+        # only ints and floats; converting straight to float64 would also accept strings like '10'
+        if locations_arr.dtype.kind not in 'iuf':
+            raise TypeError(error_message)
+        if locations_arr.ndim not in (1, 2) or locations_arr.shape[-1] != 2:
+            raise TypeError(error_message)
+        locations_arr = locations_arr.astype(np.float64, copy=False)
+        if locations_arr.ndim == 2:
             logger.critical('we assume the first arg is latitude and second arg is longitude')
-        else:
-            if isinstance(location_peek, float) or isinstance(location_peek, int):
-                locations_df = pd.DataFrame([locations])
-            else:
-                raise TypeError('only two types of input are supported: 1. [10, 20] or [[10, 20], [30, 30]]')
 
-        locations_df.columns = ['LAT', 'LON']
+        locations_df = pd.DataFrame(locations_arr.reshape(-1, 2), columns=['LAT', 'LON'])
         return cls(locations=locations_df,
                    start_date=start_date,
                    end_date=end_date,
                    lat_col='LAT',
-                   lon_col='LON')
+                   lon_col='LON',
+                   cache_dir=cache_dir)
 
     @staticmethod
     def read_dataset(local_data_dir):
@@ -78,29 +104,71 @@ class SeaSurfaceTempDownloader:
         convert the netCDF dataset into a dictionary
 
         we also use variable['lat'][:] to convert values to numpy type
-        because doing this speed the slicing up significantly
+        because doing this speed the slicing up significantly.
+        sst and time are kept as netCDF variables since the full sst array is ~1.5 GB a year
+        and only a few locations are needed; the dataset handle is returned
+        as well so the caller can close it after slicing.
         """
         sst_data = Dataset(local_data_dir, mode='r')
+        # missing data (-9.96921e+36) come back masked and are filled with np.nan later;
+        # packed values are unpacked with scale_factor/add_offset
+        sst_data.set_auto_maskandscale(True)
         lat = sst_data.variables['lat'][:]  # this makes it an np array; faster than original type
         lon = sst_data.variables['lon'][:]
-        sst = sst_data.variables['sst'][:]
-        time = sst_data.variables['time'][:]
-        lon = np.array([term if term <= 180 else (term - 360) for term in lon])
+        sst = sst_data.variables['sst']
+        time = sst_data.variables['time']  # not read here; get_time_index only reads the entries it needs
         return {'lat': lat,
                 'lon': lon,
                 'time': time,
-                'sst': sst}
+                'sst': sst,
+                'dataset': sst_data}
 
     def get_lat_lon_index(self, lat, lon):
         """
         A helper function to get the lat and lon index of the sst data,
         which will be later used for slicing.
+        The result is cached since the grid is identical across years.
 
         Background info:
         The sst data could be sliced as sst[correct_date, correct_lat, correct_lon]
         We will find out the *index* of the closet locations provided by the
-        user.
+        user. The raw longitude runs from 0 to 360, so user longitudes are wrapped
+        into the same range first.
+
+        For a regular grid (always the case for NOAA OISST) the index is simply
+        the rounded distance to the first grid point divided by the spacing.
+        The KDTree is only used as a fallback for irregular grids.
         """
+        if self._grid_index_cache is not None:
+            return self._grid_index_cache
+
+        # the index arithmetic would silently map nan/inf or |lat| > 90 to some valid grid cell
+        invalid = ~np.isfinite(self._locations_arr).all(axis=1)
+        invalid[~invalid] = np.abs(self._locations_arr[~invalid, 0]) > 90
+        if invalid.any():
+            raise ValueError('locations must have finite coordinates and a latitude within [-90, 90], '
+                             f'check the rows {self.locations.index[invalid].tolist()}')
+
+        # repeated locations (e.g., station tables) only need to be looked up once
+        unique_locations, inverse = np.unique(self._locations_arr, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        user_lat = unique_locations[:, 0]
+        user_lon = unique_locations[:, 1] % 360
+
+        def is_uniform(axis):
+            return len(axis) > 1 and np.allclose(np.diff(axis), axis[1] - axis[0])
+
+        if is_uniform(lat) and is_uniform(lon):
+            d_lat = lat[1] - lat[0]
+            d_lon = lon[1] - lon[0]
+            lat_idx = np.clip(np.round((user_lat - lat[0]) / d_lat).astype(int), 0, len(lat) - 1)
+            lon_idx = np.round((user_lon - lon[0]) / d_lon).astype(int)
+            if np.isclose(len(lon) * d_lon, 360):
+                lon_idx = lon_idx % len(lon)  # global grid: the last column is adjacent to the first one
+            else:
+                lon_idx = np.clip(lon_idx, 0, len(lon) - 1)
+            self._grid_index_cache = (lat_idx[inverse], lon_idx[inverse])
+            return self._grid_index_cache
 
         def build_2d_meshgrid(lat, lon):
             xx, yy = np.meshgrid(lat, lon)
@@ -114,26 +182,67 @@ class SeaSurfaceTempDownloader:
         lat_lon_matrix = build_2d_meshgrid(lat, lon)
         lat_lon_idx_matrix = build_2d_meshgrid(lat_idx, lon_idx)
 
-        tree = KDTree(lat_lon_matrix)
-        dist, idx = tree.query(self.locations)
+        # the tree is queried only once, so a faster build beats a slightly tighter tree
+        tree = cKDTree(lat_lon_matrix, balanced_tree=False, compact_nodes=False)
+        dist, idx = tree.query(np.column_stack([user_lat, user_lon]), workers=-1)
 
         locations_in_original_data = lat_lon_idx_matrix[idx]
-        lat_idx = locations_in_original_data[:, 0]
-        lon_idx = locations_in_original_data[:, 1]
+        lat_idx = locations_in_original_data[inverse, 0]
+        lon_idx = locations_in_original_data[inverse, 1]
+        self._grid_index_cache = (lat_idx, lon_idx)
         return lat_idx, lon_idx
 
     def get_time_index(self, dataset, list_of_regular_time):
         """
-        convert the user provide time such as 2010-01-01 to 2010-10-01 into dates in seconds.
+        convert the user provide time such as 2010-01-01 to 2010-10-01 into the index along the time axis.
+
+        the time axis is stored as days since 1800-01-01 in ascending order, so we convert the user dates
+        into the unit stored in the file instead of decoding the time axis.
+        The axis is daily without gaps, hence the index is just the offset from the first day,
+        which is confirmed by reading only those entries. Otherwise, we fall back to a binary search.
+        """
+        time_variable = dataset['time']
+        user_days = date2num(pd.DatetimeIndex(list_of_regular_time).normalize().to_pydatetime(),
+                             units=getattr(time_variable, 'units', 'days since 1800-01-01 00:00:00'),
+                             calendar=getattr(time_variable, 'calendar', 'standard'))
+        user_days = np.asarray(user_days, dtype=np.int64)
+
+        time_index = user_days - int(time_variable[0])  # used for slicing later in the sst data
+        if ((time_index >= 0) & (time_index < len(time_variable))).all():
+            if (np.asarray(time_variable[time_index], dtype=np.int64) == user_days).all():
+                return time_index
+
+        timeline = np.asarray(time_variable[:], dtype=np.int64)
+        time_index = np.searchsorted(timeline, user_days)
+        found = time_index < len(timeline)
+        found[found] = timeline[time_index[found]] == user_days[found]
+        if not found.all():
+            missing = pd.DatetimeIndex(list_of_regular_time)[~found]
+            raise KeyError(f'{len(missing)} dates are not available in the sst data, e.g., {missing[0].date()}')
+        return time_index
+
+    @staticmethod
+    def slice_sst(sst_variable, time_index, lat_index, lon_index, max_values_per_read=2 ** 22):
         """
-        timeline = dataset['time']
-        regular_time_to_index = {str(date(1800, 1, 1) + timedelta(int(t))): i for i, t in enumerate(timeline)}
+        read the sst values at (lat_index[i], lon_index[i]) for every day in time_index.
+
+        netCDF variables index each dimension independently, so we read the contiguous
+        box covering all locations and pick the points in memory.
+        Consecutive days are read together in one hyperslab, as many as fit in
+        max_values_per_read, which keeps the number of reads low without loading the year.
+        The result is a float32 masked array ordered by day first and location second;
+        OISST only carries single precision, so float64 would just double the memory.
+        """
+        lat_start, lat_stop = lat_index.min(), lat_index.max() + 1
+        lon_start, lon_stop = lon_index.min(), lon_index.max() + 1
+        days_per_read = max(1, max_values_per_read // ((lat_stop - lat_start) * (lon_stop - lon_start)))
 
-        time_index_list = []  # used for slicing later in the sst data
-        for regular_time in list_of_regular_time:
-            regular_time = str(regular_time).split(' ')[0]  # 1985-01-01 00:00:00
-            time_index_list.append(regular_time_to_index[regular_time])
-        return time_index_list
+        sst_by_day = []
+        for i in range(0, len(time_index), days_per_read):
+            # a run of consecutive indices is turned into a single slice by netCDF4
+            box = sst_variable[time_index[i:i + days_per_read], lat_start:lat_stop, lon_start:lon_stop]
+            sst_by_day.append(box[:, lat_index - lat_start, lon_index - lon_start].reshape(-1))
+        return np.ma.concatenate(sst_by_day).astype(np.float32, copy=False)
 
     @cached_property
     def remote_to_local_dir_mapping(self):
@@ -147,23 +256,123 @@ class SeaSurfaceTempDownloader:
         for time_stamp in pd.date_range(self.start_date, self.end_date):
             year_to_timestamp[time_stamp.year].append(time_stamp)
 
-        remote_to_local = defaultdict(list)
+        remote_to_local: Dict[str, Tuple[str, list]] = {}
         for year in year_to_timestamp:
-            local_dir = os.path.join(self.temp_dir, f'sst.day.mean.{year}.nc')
+            local_dir = os.path.join(self.cache_dir, f'sst.day.mean.{year}.nc')
             remote_url = self.sst_data_parent_dir + f'sst.day.mean.{year}.nc'
-            remote_to_local[remote_url].append([local_dir, year_to_timestamp[year]])
+            remote_to_local[remote_url] = (local_dir, year_to_timestamp[year])
         return remote_to_local
 
     @staticmethod
-    def download_to_local(link_in, dir_out):
+    def download_to_local(link_in, dir_out, chunk_size=16 * 1024 * 1024, max_workers=4):
         """
         download the sst information to local dir.
         :param link_in: the url pointing to the file to be downloaded
         :param dir_out: the local dir where the file is stored
+        :param chunk_size: size in bytes of each byte range requested in parallel
+        :param max_workers: number of byte ranges of this file downloaded at the same time;
+        the connections of all files downloaded concurrently are capped by MAX_CONNECTIONS
+
+        a cached file is reused if its size matches the remote Content-Length; the file of the
+        current year keeps growing on the server, so it will be refreshed when it changes.
+        the file is written under a unique temporary name first and renamed only when all
+        the bytes arrived, so an interrupted or concurrent download never leaves a broken file in the cache.
+        """
+        try:
+            with _connection_slots:
+                head = requests.head(link_in, allow_redirects=True, timeout=60)
+            head.raise_for_status()
+            remote_headers = head.headers
+        except requests.RequestException as error:
+            if os.path.exists(dir_out):
+                logger.critical(f'cannot reach {link_in}, using the cached file {dir_out}')
+                return
+            if not isinstance(error, requests.HTTPError):
+                raise
+            # the server is up but refuses HEAD (e.g., 405); download the whole file in one stream
+            logger.critical(f'HEAD request to {link_in} failed ({error}), downloading without size check')
+            remote_headers = {}
+
+        total = int(remote_headers.get('Content-Length', 0))
+        if os.path.exists(dir_out) and (total == 0 or os.path.getsize(dir_out) == total):
+            return
+
+        # a partial file of our own, so concurrent downloads of the same year (e.g., two notebooks
+        # sharing the cache) never write into each other's file
+        file_handle, partial_dir_out = tempfile.mkstemp(dir=os.path.dirname(dir_out) or '.',
+                                                        prefix=os.path.basename(dir_out) + '.',
+                                                        suffix='.part')
+        os.close(file_handle)
+        progress_lock = Lock()
+
+        try:
+            with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, total=total or None,
+                                     desc=link_in.split('/')[-1]) as t:
+
+                def fetch(byte_range=None):
+                    headers = {} if byte_range is None else {'Range': 'bytes={}-{}'.format(*byte_range)}
+                    written = 0
+                    with _connection_slots, requests.get(link_in, headers=headers, stream=True, timeout=60) as response:
+                        response.raise_for_status()
+                        if byte_range is not None and response.status_code != 206:
+                            raise IOError(f'{link_in} ignored the range request')
+                        mode = 'wb' if byte_range is None else 'r+b'
+                        with open(partial_dir_out, mode) as file_out:
+                            if byte_range is not None:
+                                file_out.seek(byte_range[0])
+                            for block in response.iter_content(chunk_size=1024 * 1024):
+                                file_out.write(block)
+                                written += len(block)
+                                with progress_lock:
+                                    t.update(len(block))
+                    if byte_range is not None and written != byte_range[1] - byte_range[0] + 1:
+                        raise IOError(f'incomplete range {byte_range} from {link_in}')
+                    return written
+
+                if total and remote_headers.get('Accept-Ranges') == 'bytes':
+                    with open(partial_dir_out, 'wb') as file_out:
+                        file_out.truncate(total)  # preallocate so every range can be written in place
+                    byte_ranges = [(start, min(start + chunk_size, total) - 1)
+                                   for start in range(0, total, chunk_size)]
+                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        written = sum(executor.map(fetch, byte_ranges))
+                else:
+                    written = fetch()
+
+            if total and (written != total or os.path.getsize(partial_dir_out) != total):
+                raise IOError(f'expected {total} bytes from {link_in}, received {written}')
+            os.replace(partial_dir_out, dir_out)
+        except BaseException:
+            os.remove(partial_dir_out)
+            raise
+
+    def _process_year(self, local_dir, all_dates_in_that_year, output):
+        """
+        slice the sst values of one downloaded yearly file and write them into output,
+        a dict of preallocated arrays (views) with one entry per day and location.
         """
-        if not os.path.exists(dir_out):
-            with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=link_in.split('/')[-1]) as t:
-                request.urlretrieve(link_in, dir_out, t.update_to)
+        dataset = self.read_dataset(local_dir)
+
+        try:
+            time_index = self.get_time_index(dataset=dataset, list_of_regular_time=all_dates_in_that_year)
+            lat_index, lon_index = self.get_lat_lon_index(lat=dataset['lat'], lon=dataset['lon'])
+            sst = self.slice_sst(dataset['sst'], time_index, lat_index, lon_index)
+        finally:
+            dataset['dataset'].close()
+
+        # get real value (not index) to prepare for the output dataframe;
+        # look up each location once and let the assignment broadcast it over the days (and each day over the locations)
+        lat = np.asarray(dataset['lat'][lat_index], dtype=np.float32)
+        lon = np.asarray(dataset['lon'][lon_index], dtype=np.float32)
+        lon = np.where(lon > 180, lon - 360, lon).astype(lon.dtype, copy=False)
+        dim = (len(time_index), len(lat_index))
+
+        dates = pd.DatetimeIndex(all_dates_in_that_year).values  # native datetime64 instead of Timestamp objects
+
+        output['DATE'].reshape(dim)[:] = dates[:, np.newaxis]
+        output['LAT'].reshape(dim)[:] = lat
+        output['LON'].reshape(dim)[:] = lon
+        output['SST'][:] = sst.filled(np.nan)
 
     def download(self):
         """
@@ -176,56 +385,64 @@ class SeaSurfaceTempDownloader:
         day2 lat2 lon2 sst5
         day2 lat3 lon3 sst6
 
-        that's why use np.repeat for dates
-        """
-        result = []
-        for year_count, (url, bundle) in enumerate(self.remote_to_local_dir_mapping.items()):
-            local_dir, all_dates_in_that_year = bundle[0]
-            logger.critical('-' * 10 + 'start downloading' + f' year #{year_count + 1}' + '-' * 10)
-            self.download_to_local(url, local_dir)
-            logger.critical('-' * 10 + 'finished downloading' + f' year #{year_count + 1}' + '-' * 10)
-            dataset = self.read_dataset(local_dir)
-
-            time_index = self.get_time_index(dataset=dataset, list_of_regular_time=all_dates_in_that_year)
-            lat_index, lon_index = self.get_lat_lon_index(lat=dataset['lat'], lon=dataset['lon'])
-
-            time_index_stretched_to_match_dim = np.repeat(time_index, len(lat_index))
-            lat_index_stretched_to_match_dim = np.tile(lat_index, len(time_index))
-            lon_index_stretched_to_match_dim = np.tile(lon_index, len(time_index))
+        that's why dates are repeated for every location
 
-            sst = dataset['sst'][time_index_stretched_to_match_dim,
-                                 lat_index_stretched_to_match_dim,
-                                 lon_index_stretched_to_match_dim]
-
-            # get real value (not index) to prepare for the output dataframe
-            lat = dataset['lat'][lat_index_stretched_to_match_dim]
-            lon = dataset['lon'][lon_index_stretched_to_match_dim]
-
-            data = np.array([np.repeat(all_dates_in_that_year, len(lat_index)), lat, lon, sst]).T
-            df = pd.DataFrame(data, columns=['DATE', 'LAT', 'LON', 'SST'])
-            result.append(df)
+        the yearly files are downloaded concurrently, and each year is processed as soon as
+        its file arrives while the later years are still downloading.
+        HDF5 is not thread safe, hence the netCDF files are only read from this thread.
+        """
+        mapping = self.remote_to_local_dir_mapping
+        logger.critical('-' * 10 + 'start downloading' + f' {len(mapping)} year(s)' + '-' * 10)
+
+        # the size of the output is known up front, so each year writes straight into its slice
+        # of the final columns instead of building yearly dataframes to be concatenated
+        num_locations = len(self._locations_arr)
+        total = sum(len(dates) for _, dates in mapping.values()) * num_locations
+        columns = {'DATE': np.empty(total, dtype='datetime64[ns]'),
+                   'LAT': np.empty(total, dtype=np.float32),
+                   'LON': np.empty(total, dtype=np.float32),
+                   'SST': np.empty(total, dtype=np.float32)}
+
+        offset = 0
+        with ThreadPoolExecutor(max_workers=min(MAX_CONNECTIONS, len(mapping))) as executor:
+            downloads = [executor.submit(self.download_to_local, url, local_dir)
+                         for url, (local_dir, _) in mapping.items()]
+            try:
+                for year_count, (local_dir, all_dates_in_that_year) in enumerate(mapping.values()):
+                    downloads[year_count].result()
+                    logger.critical('-' * 10 + 'finished downloading' + f' year #{year_count + 1}' + '-' * 10)
+                    rows = len(all_dates_in_that_year) * num_locations
+                    self._process_year(local_dir,
+                                       all_dates_in_that_year,
+                                       {name: column[offset:offset + rows] for name, column in columns.items()})
+                    offset += rows
+            except BaseException:
+                # do not wait for the remaining yearly files before reporting the error
+                for future in downloads:
+                    future.cancel()
+                raise
+
+        output = pd.DataFrame(columns, copy=False)
 
         # check if all is none, will raise a warning if so
-        output = pd.concat(result).reset_index(drop=True)
-
         null_values = output['SST'].isnull().sum()
         if null_values == len(output):
             warnings.warn('all the sst measurements are null values'
                           'this is usually because the locations you provided are on the land')
-        # missing data are marked as -9.96921e+36, we convert them to np.nan
-        output.loc[output['SST'] < -9e35, 'SST'] = np.nan
         return output
 
 
-def download_sst(locations, start_date, end_date):
+def download_sst(locations, start_date, end_date, cache_dir=None):
     if isinstance(locations, pd.DataFrame):
         downloader = SeaSurfaceTempDownloader(locations=locations,
                                               start_date=start_date,
-                                              end_date=end_date)
+                                              end_date=end_date,
+                                              cache_dir=cache_dir)
     elif isinstance(locations, (tuple, list)):
         downloader = SeaSurfaceTempDownloader.from_tuples(locations=locations,
                                                           start_date=start_date,
-                                                          end_date=end_date)
+                                                          end_date=end_date,
+                                                          cache_dir=cache_dir)
     elif isinstance(locations, str) and len(locations) == 2:
         raise TypeError('we do not support state abbreviation when downloading sst,'
                         'since such data are only available on the sea.')
@@ -0,0 +1,359 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from netCDF4 import Dataset
+
+from ..hydrological_toolbox.data import download_sea_surface_temperature
+from ..hydrological_toolbox.data.download_sea_surface_temperature import SeaSurfaceTempDownloader
+
+FILL_VALUE = np.float32(-9.96921e36)
+OISST_LAT = np.arange(720) * 0.25 - 89.875
+OISST_LON = np.arange(1440) * 0.25 + 0.125
+
+
+def expected_sst(day, lat_idx, lon_idx):
+    # the synthetic sst encodes where it comes from: day + lat_idx / 1e3 + lon_idx / 1e5
+    return np.float32(day + lat_idx * 0.001 + lon_idx * 0.00001)
+
+
+def write_sst_file(path, days_since_1800, lat=OISST_LAT, lon=OISST_LON):
+    """
+    write a small file with the layout of NOAA OISST; the block lat 0.125..9.875, lon 250.125..274.875 is land
+    """
+    with Dataset(path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('lat', len(lat))
+        dataset.createDimension('lon', len(lon))
+        dataset.createVariable('lat', 'f4', ('lat',))[:] = lat
+        dataset.createVariable('lon', 'f4', ('lon',))[:] = lon
+        time = dataset.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1800-01-01 00:00:00'
+        time[:] = days_since_1800
+        sst = dataset.createVariable('sst', 'f4', ('time', 'lat', 'lon'), zlib=True,
+                                     chunksizes=(1, len(lat), len(lon)), fill_value=FILL_VALUE)
+        sst.missing_value = FILL_VALUE
+        lat_idx = np.arange(len(lat))[:, None]
+        lon_idx = np.arange(len(lon))[None, :]
+        for day in range(len(days_since_1800)):
+            values = np.broadcast_to(expected_sst(day, lat_idx, lon_idx), (len(lat), len(lon))).copy()
+            values[360:400, 1000:1100] = FILL_VALUE
+            sst[day] = values
+
+
+def days_since_1800(first_day, num_days):
+    return np.arange(num_days) + (date.fromisoformat(first_day) - date(1800, 1, 1)).days
+
+
+@pytest.fixture
+def sst_dir(tmp_path, monkeypatch):
+    write_sst_file(str(tmp_path / 'sst.day.mean.2015.nc'), days_since_1800('2015-01-01', 10))
+    # never reach out to NOAA; the yearly file is already in the cache dir
+    monkeypatch.setattr(SeaSurfaceTempDownloader, 'download_to_local', staticmethod(lambda link_in, dir_out: None))
+    return str(tmp_path)
+
+
+def test_download_sst_synthetic_file(sst_dir):
+    result = download_sea_surface_temperature.download_sst(locations=[[32.7, -79.9], [5.1, -100.1], [-10.01, 359.9]],
+                                                           start_date='2015-01-02',
+                                                           end_date='2015-01-04',
+                                                           cache_dir=sst_dir)
+    assert list(result.columns) == ['DATE', 'LAT', 'LON', 'SST']
+    assert result['DATE'].dtype == np.dtype('datetime64[ns]')
+    assert (result[['LAT', 'LON', 'SST']].dtypes == np.float32).all()
+
+    assert len(result) == 9
+    assert (result['DATE'] == pd.Timestamp('2015-01-03')).sum() == 3
+    assert result['LAT'].tolist() == [32.625, 5.125, -10.125] * 3
+    # 359.9 is right next to the 0/360 seam, so the closest grid point is -0.125
+    assert result['LON'].tolist() == [-79.875, -100.125, -0.125] * 3
+
+    expected = [expected_sst(day, lat_idx, lon_idx)
+                for day in (1, 2, 3)
+                for lat_idx, lon_idx in [(490, 1120), (380, 1039), (319, 1439)]]
+    expected[1::3] = [np.nan] * 3  # on the land
+    np.testing.assert_array_equal(result['SST'].to_numpy(), np.array(expected, dtype=np.float32))
+
+
+def test_download_sst_from_dataframe(sst_dir):
+    df = pd.DataFrame([[32.7, -79.9], [32.7, -79.9]], columns=['LAT', 'LON'])
+    result = download_sea_surface_temperature.download_sst(locations=df,
+                                                           start_date='2015-01-10',
+                                                           end_date='2015-01-10',
+                                                           cache_dir=sst_dir)
+    assert len(result) == 2
+    assert result['SST'].tolist() == [expected_sst(9, 490, 1120)] * 2
+
+
+def test_download_sst_all_land(sst_dir):
+    with pytest.warns(UserWarning):
+        result = download_sea_surface_temperature.download_sst(locations=[5.1, -100.1],
+                                                               start_date='2015-01-01',
+                                                               end_date='2015-01-02',
+                                                               cache_dir=sst_dir)
+    assert result['SST'].isnull().all()
+
+
+def test_get_lat_lon_index_regular_grid(tmp_path):
+    locations = [[-89.9, 0.0], [89.9, 180.1], [0.1, 359.9], [0.1, -0.1], [0.1, 0.1], [-89.9, 0.0]]
+    downloader = SeaSurfaceTempDownloader.from_tuples(locations, '2015-01-01', '2015-01-02', cache_dir=str(tmp_path))
+    lat_idx, lon_idx = downloader.get_lat_lon_index(lat=OISST_LAT, lon=OISST_LON)
+    assert lat_idx.tolist() == [0, 719, 360, 360, 360, 0]
+    assert lon_idx.tolist() == [0, 720, 1439, 1439, 0, 0]
+
+
+def test_get_lat_lon_index_irregular_grid(tmp_path):
+    downloader = SeaSurfaceTempDownloader.from_tuples([[1.1, -2.0], [3.0, 5.2], [1.1, -2.0]],
+                                                      '2015-01-01', '2015-01-02', cache_dir=str(tmp_path))
+    lat_idx, lon_idx = downloader.get_lat_lon_index(lat=np.array([0., 1., 3., 6.]),
+                                                    lon=np.array([0., 5., 355., 358.]))
+    assert lat_idx.tolist() == [1, 2, 1]
+    assert lon_idx.tolist() == [3, 1, 3]
+
+
+@pytest.mark.parametrize('location', [[np.nan, 10.0], [10.0, np.inf], [90.5, 10.0], [-91.0, 10.0]])
+def test_get_lat_lon_index_invalid_locations(tmp_path, location):
+    downloader = SeaSurfaceTempDownloader.from_tuples([[0.0, 0.0], location], '2015-01-01', '2015-01-02',
+                                                      cache_dir=str(tmp_path))
+    with pytest.raises(ValueError, match=r'\[1\]'):
+        downloader.get_lat_lon_index(lat=OISST_LAT, lon=OISST_LON)
+
+
+# from one day per read up to the whole request in a single read
+@pytest.mark.parametrize('max_values_per_read', [1, 3 * 700 * 1440, 2 ** 22])
+def test_slice_sst(tmp_path, max_values_per_read):
+    path = str(tmp_path / 'sst.nc')
+    write_sst_file(path, days_since_1800('2015-01-01', 12))
+    time_index = np.array([0, 1, 2, 5, 9, 10, 11])
+    lat_index = np.array([3, 700, 380, 3])
+    lon_index = np.array([1439, 0, 1050, 2])
+
+    with Dataset(path) as dataset:
+        sst = SeaSurfaceTempDownloader.slice_sst(dataset['sst'], time_index, lat_index, lon_index,
+                                                 max_values_per_read=max_values_per_read)
+
+    assert sst.dtype == np.float32
+    assert sst.shape == (len(time_index) * len(lat_index), )
+    expected = np.array([expected_sst(t, lat, lon) for t in time_index for lat, lon in zip(lat_index, lon_index)])
+    land = np.tile([False, False, True, False], len(time_index))
+    assert (sst.mask == land).all()
+    np.testing.assert_array_equal(sst[~land], expected[~land])
+
+
+def test_start_date_after_end_date(tmp_path):
+    with pytest.raises(ValueError):
+        SeaSurfaceTempDownloader.from_tuples([10, 20], '2015-01-02', '2015-01-01', cache_dir=str(tmp_path))
+
+
+def test_download_sst_cancels_pending_years(tmp_path, monkeypatch):
+    requested = []
+
+    def download_to_local(link_in, dir_out):
+        requested.append(link_in)
+        if link_in.endswith('2006.nc'):
+            raise IOError('connection reset')
+        time.sleep(0.5)
+
+    monkeypatch.setattr(SeaSurfaceTempDownloader, 'download_to_local', staticmethod(download_to_local))
+    with pytest.raises(IOError):
+        download_sea_surface_temperature.download_sst(locations=[10, 20],
+                                                      start_date='2006-12-31',
+                                                      end_date='2015-01-01',
+                                                      cache_dir=str(tmp_path))
+    # ten yearly files, but only the ones already running when 2006 failed were fetched
+    assert len(requested) < 10
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, body=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} error')
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            time.sleep(0.001)
+            yield self.body[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeServer:
+    """
+    stands in for requests.head/requests.get; records the Range header of every GET
+    """
+    def __init__(self, body, head_status=200, honour_ranges=True, failing_range_start=None):
+        self.body = body
+        self.head_status = head_status
+        self.honour_ranges = honour_ranges
+        self.failing_range_start = failing_range_start
+        self.ranges = []
+
+    def head(self, url, **kwargs):
+        if isinstance(self.head_status, Exception):
+            raise self.head_status
+        return FakeResponse(self.head_status, {'Content-Length': str(len(self.body)), 'Accept-Ranges': 'bytes'})
+
+    def get(self, url, headers=None, **kwargs):
+        byte_range = (headers or {}).get('Range')
+        self.ranges.append(byte_range)
+        if byte_range is None or not self.honour_ranges:
+            return FakeResponse(200, body=self.body)
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', byte_range).groups())
+        if start == self.failing_range_start:
+            return FakeResponse(500)
+        return FakeResponse(206, body=self.body[start:end + 1])
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    def install(**kwargs):
+        server = FakeServer(np.random.default_rng(0).bytes(1000), **kwargs)
+        monkeypatch.setattr(download_sea_surface_temperature.requests, 'head', server.head)
+        monkeypatch.setattr(download_sea_surface_temperature.requests, 'get', server.get)
+        return server
+    return install
+
+
+def read_bytes(path):
+    with open(path, 'rb') as file_in:
+        return file_in.read()
+
+
+def test_download_to_local_concurrent_calls(tmp_path, fake_server):
+    server = fake_server()
+    dir_out = str(tmp_path / 'sst.day.mean.2015.nc')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: SeaSurfaceTempDownloader.download_to_local('url', dir_out, chunk_size=64),
+                          range(4)))
+    assert read_bytes(dir_out) == server.body
+    assert os.listdir(str(tmp_path)) == ['sst.day.mean.2015.nc']
+
+
+def test_download_to_local_uneven_ranges(tmp_path, fake_server):
+    server = fake_server()
+    dir_out = str(tmp_path / 'sst.nc')
+    SeaSurfaceTempDownloader.download_to_local('url', dir_out, chunk_size=300)
+    assert read_bytes(dir_out) == server.body
+    assert sorted(server.ranges) == ['bytes=0-299', 'bytes=300-599', 'bytes=600-899', 'bytes=900-999']
+
+
+def test_download_to_local_head_refused(tmp_path, fake_server):
+    server = fake_server(head_status=405)
+    dir_out = str(tmp_path / 'sst.nc')
+    SeaSurfaceTempDownloader.download_to_local('url', dir_out, chunk_size=300)
+    assert read_bytes(dir_out) == server.body
+    assert server.ranges == [None]  # a single GET of the whole file
+
+
+@pytest.mark.parametrize('head_status', [requests.ConnectionError('offline'), 405])
+def test_download_to_local_head_fails_with_cached_file(tmp_path, fake_server, head_status):
+    server = fake_server(head_status=head_status)
+    dir_out = tmp_path / 'sst.nc'
+    dir_out.write_bytes(b'cached')
+    SeaSurfaceTempDownloader.download_to_local('url', str(dir_out))
+    assert dir_out.read_bytes() == b'cached'
+    assert server.ranges == []
+
+
+def test_download_to_local_cached_file_same_size(tmp_path, fake_server):
+    server = fake_server()
+    dir_out = tmp_path / 'sst.nc'
+    dir_out.write_bytes(b'x' * len(server.body))
+    SeaSurfaceTempDownloader.download_to_local('url', str(dir_out))
+    assert dir_out.read_bytes() == b'x' * len(server.body)
+    assert server.ranges == []
+
+
+def test_download_to_local_cached_file_different_size(tmp_path, fake_server):
+    server = fake_server()
+    dir_out = tmp_path / 'sst.nc'
+    dir_out.write_bytes(b'stale')
+    SeaSurfaceTempDownloader.download_to_local('url', str(dir_out), chunk_size=300)
+    assert dir_out.read_bytes() == server.body
+
+
+def test_download_to_local_range_ignored(tmp_path, fake_server):
+    fake_server(honour_ranges=False)
+    with pytest.raises(IOError, match='ignored the range request'):
+        SeaSurfaceTempDownloader.download_to_local('url', str(tmp_path / 'sst.nc'), chunk_size=300)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_to_local_failed_range(tmp_path, fake_server):
+    fake_server(failing_range_start=600)
+    dir_out = tmp_path / 'sst.nc'
+    dir_out.write_bytes(b'stale')
+    with pytest.raises(requests.HTTPError):
+        SeaSurfaceTempDownloader.download_to_local('url', str(dir_out), chunk_size=300)
+    assert dir_out.read_bytes() == b'stale'
+    assert os.listdir(str(tmp_path)) == ['sst.nc']
+
+
+@pytest.mark.parametrize('locations, expected', [
+    ([10, 20], [[10.0, 20.0]]),
+    ((10.5, 20), [[10.5, 20.0]]),
+    ([(1, 2), (3, 4)], [[1.0, 2.0], [3.0, 4.0]]),
+    ([[1, 2], [3, 4]], [[1.0, 2.0], [3.0, 4.0]]),
+])
+def test_from_tuples(tmp_path, locations, expected):
+    downloader = SeaSurfaceTempDownloader.from_tuples(locations, '2015-01-01', '2015-01-02', cache_dir=str(tmp_path))
+    assert downloader.locations.values.tolist() == expected
+    assert list(downloader.locations.columns) == ['LAT', 'LON']
+
+
+@pytest.mark.parametrize('locations', [['a', 'b'], [1, 2, 3], [[1, 2], [3]], [[[1, 2]]],
+                                       # numeric strings and booleans are not coordinates either
+                                       ('10', '20'), [[1, '2'], [3, 4]], [True, False]])
+def test_from_tuples_invalid_input(tmp_path, locations):
+    with pytest.raises(TypeError):
+        SeaSurfaceTempDownloader.from_tuples(locations, '2015-01-01', '2015-01-02', cache_dir=str(tmp_path))
+
+
+@pytest.mark.parametrize('days, dates, expected', [
+    (days_since_1800('2016-01-01', 10), ['2016-01-03', '2016-01-04', '2016-01-05'], [2, 3, 4]),
+    # a gap in the time axis falls back to the binary search
+    (days_since_1800('2016-01-01', 5)[[0, 2, 3, 4]], ['2016-01-03', '2016-01-05'], [1, 3]),
+])
+def test_get_time_index(tmp_path, days, dates, expected):
+    path = str(tmp_path / 'sst.nc')
+    write_sst_file(path, days, lat=OISST_LAT[:2], lon=OISST_LON[:2])
+    downloader = SeaSurfaceTempDownloader.from_tuples([0.0, 0.0], '2016-01-01', '2016-01-02', cache_dir=str(tmp_path))
+
+    dataset = SeaSurfaceTempDownloader.read_dataset(path)
+    try:
+        time_index = downloader.get_time_index(dataset, pd.DatetimeIndex(dates))
+    finally:
+        dataset['dataset'].close()
+    assert time_index.tolist() == expected
+
+
+@pytest.mark.parametrize('days, dates', [
+    (days_since_1800('2016-01-01', 10), ['2016-01-09', '2016-01-11']),
+    (days_since_1800('2016-01-01', 5)[[0, 2, 3, 4]], ['2016-01-02']),
+])
+def test_get_time_index_missing_dates(tmp_path, days, dates):
+    path = str(tmp_path / 'sst.nc')
+    write_sst_file(path, days, lat=OISST_LAT[:2], lon=OISST_LON[:2])
+    downloader = SeaSurfaceTempDownloader.from_tuples([0.0, 0.0], '2016-01-01', '2016-01-02', cache_dir=str(tmp_path))
+
+    dataset = SeaSurfaceTempDownloader.read_dataset(path)
+    try:
+        with pytest.raises(KeyError):
+            downloader.get_time_index(dataset, pd.DatetimeIndex(dates))
+    finally:
+        dataset['dataset'].close()